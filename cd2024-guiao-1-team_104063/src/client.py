@@ -1,11 +1,17 @@
 """CD Chat client program"""
+import asyncio
 import logging
-import selectors
+import os
 import socket
 import sys
 import threading
 
-from src.protocol import CDProto,  RegisterMessage, JoinMessage, TextMessage
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from src.protocol import CDProto, CDProtoBadFormat, RegisterMessage, JoinMessage, TextMessage
 
 
 logging.basicConfig(filename=f"{sys.argv[0]}.log", level=logging.DEBUG)
@@ -23,75 +29,172 @@ class Client:
 
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-        self.selector = selectors.DefaultSelector()
+        self.event_loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+        self.user_input = b""       #typed bytes not yet ended by a newline
       
 
 
     def connect(self):
-        """Connect to chat server and start thread to read from user """
+        """Connect to chat server and watch it and the user input for reads."""
         self.client.connect(("127.0.0.1", 8888))
         self.client.setblocking(False)
+        self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-        self.selector.register(self.client, selectors.EVENT_READ, self.handle_server_input)
+        self.event_loop.add_reader(self.client.fileno(), self.handle_server_input, self.client, None)
+        try:
+            self.event_loop.add_reader(sys.stdin.fileno(), self.handle_user_input)
+        except PermissionError:
+            #stdin is a regular file, epoll can't watch it, read it on a thread
+            threading.Thread(target=self.read_user_input, daemon=True).start()
 
-        CDProto.send_msg(self.client,RegisterMessage(self.name))
+        self.send(RegisterMessage(self.name))
         logging.debug(f'register %s', self.name)
       
 
     def loop(self):
-        """Loop indefinetely."""
-        threading.Thread(target=self.handle_user_input, daemon=True).start()
-        while True:
-            events = self.selector.select()
-            for key, mask in events:
-                callback = key.data
-                callback(key.fileobj, mask)
+        """Loop until the user exits."""
+        try:
+            self.event_loop.run_forever()
+        finally:
+            self.event_loop.close()
 
 
     def handle_server_input(self, conn, mask):
-        channel_messages = CDProto.recv_msg(conn)
+        try:
+            #one read may bring several msgs, print all of them
+            while True:
+                try:
+                    channel_messages = CDProto.recv_msg(conn)
+                except CDProtoBadFormat:
+                    #only this frame is dropped, the ones after it may already be buffered
+                    logging.error("Message in bad format")
+                    if not CDProto.pending(conn):
+                        return
+                    continue
+
+                #server closed the connection, stop watching it
+                if channel_messages == None:
+                    self.event_loop.remove_reader(conn.fileno())
+                    logging.info("Server closed the connection.")
+                    return
+
+                command = channel_messages.type
 
-        if channel_messages != None:
-            command = channel_messages.type
+                if command == "message":
+                    print(channel_messages.message)
+                    logging.debug('received %s', channel_messages.message)
 
-            if command == "message":
-                print(channel_messages.message)
-                logging.debug('received %s', channel_messages.message)
+                if not CDProto.pending(conn):
+                    return
+
+        #rest of the msg is still on its way
+        except BlockingIOError:
+            pass
 
 
 
     def handle_user_input(self):
+        self.handle_input(os.read(sys.stdin.fileno(), 4096))
+
+
+    def read_user_input(self):
+        """Read stdin with blocking reads and hand the data to the loop."""
         while True:
-            try: 
-                message = input()
-
-                #join
-                if message.split()[0] == "/join":
-                    self.channel = message.split()[1]
-
-                    #send join msg
-                    CDProto.send_msg(self.client,JoinMessage(self.channel))
-                    logging.debug('sent "%s', message)
-
-                # exit 
-                elif message.lower() == "exit":
-                    try:
-                        self.selector.unregister(self.client)
-                        self.client.shutdown(socket.SHUT_RDWR)
-                    except OSError as e:
-                        logging.error(f"Error during client shutdown: {e}")
-                    finally:
-                        self.client.close()
-                        logging.info("Connection closed.")
-                        sys.exit(0)
-
-                #msg
-                else:
-                    CDProto.send_msg(self.client,TextMessage(message,channel=self.channel))
-                    logging.debug('sent %s', message)
-
-    
-            except (socket.timeout, socket.error):
-                print('[ERROR] Server timed out.')
-                sys.exit(0)
-            
+            data = os.read(sys.stdin.fileno(), 4096)
+            try:
+                self.event_loop.call_soon_threadsafe(self.handle_input, data)
+            except RuntimeError:        #loop already closed
+                return
+            if not data:
+                return
+
+
+    def handle_input(self, data):
+        if not data:
+            #last line may have no newline, send it before closing
+            if self.user_input:
+                line, self.user_input = self.user_input, b""
+                self.handle_raw_line(line)
+                if self.client.fileno() != -1:      #not exited
+                    #about to close, wait for any queued part to go out
+                    self.client.setblocking(True)
+                    while not CDProto.flush(self.client):
+                        pass
+            self.close()
+            return
+
+        #a read may hold several lines, or only part of one
+        self.user_input += data
+        *lines, self.user_input = self.user_input.split(b"\n")
+        for line in lines:
+            if self.client.fileno() == -1:      #exited
+                break
+            self.handle_raw_line(line)
+
+
+    def handle_raw_line(self, line):
+        """Decode and handle one typed line, an error on it must not lose the lines after it."""
+        try:
+            self.handle_line(line.decode("utf-8").rstrip("\r"))
+        except Exception as e:
+            logging.error("Failed to handle input %r: %s", line, e)
+
+
+    def handle_line(self, message):
+        try: 
+            if not message.strip():
+                return
+
+            #join
+            words = message.split()
+            if words[0] == "/join":
+                if len(words) < 2:
+                    print("Usage: /join <channel>")
+                    return
+                self.channel = words[1]
+
+                #send join msg
+                self.send(JoinMessage(self.channel))
+                logging.debug('sent "%s', message)
+
+            # exit 
+            elif message.lower() == "exit":
+                self.close()
+
+            #msg
+            else:
+                self.send(TextMessage(message,channel=self.channel))
+                logging.debug('sent %s', message)
+
+
+        except (socket.timeout, socket.error):
+            print('[ERROR] Server timed out.')
+            self.event_loop.stop()
+
+
+    def send(self, message):
+        """Send a message to the server, the rest of a partial write goes once it is writable."""
+        if not CDProto.send_msg(self.client, message):
+            self.event_loop.add_writer(self.client.fileno(), self.flush_output)
+
+
+    def flush_output(self):
+        if CDProto.flush(self.client):
+            self.event_loop.remove_writer(self.client.fileno())
+
+
+    def close(self):
+        """Close the connection and stop the loop."""
+        if self.client.fileno() == -1:
+            return
+        try:
+            self.event_loop.remove_reader(self.client.fileno())
+            self.event_loop.remove_writer(self.client.fileno())
+            self.event_loop.remove_reader(sys.stdin.fileno())
+            self.client.shutdown(socket.SHUT_RDWR)
+        except OSError as e:
+            logging.error(f"Error during client shutdown: {e}")
+        finally:
+            self.client.close()
+            logging.info("Connection closed.")
+            self.event_loop.stop()
@@ -1,59 +1,111 @@
 """Protocol for chat server - Computação Distribuida Assignment 1."""
+import abc
+import collections
 import json
-from datetime import datetime
+import logging
+import time
+import weakref
 from socket import socket
 
+try:
+    import orjson
 
-class Message:
+    def _dumps(data: dict) -> bytes:
+        """Serializes data straight to UTF-8 bytes."""
+        return orjson.dumps(data)
+
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(data: dict) -> bytes:
+        """Serializes data straight to UTF-8 bytes."""
+        return json.dumps(data).encode("utf-8")
+
+    _loads = json.loads
+
+#bytes read from each connection but not yet parsed into messages
+_buffers = weakref.WeakKeyDictionary()
+RECV_SIZE = 65536
+#bytes the kernel did not take yet for each connection, oldest first
+_outgoing = weakref.WeakKeyDictionary()
+#total size of each _outgoing queue
+_outgoing_size = weakref.WeakKeyDictionary()
+#queued bytes a connection may build up before the server drops it
+MAX_OUTGOING = 1 << 20
+
+
+class Message(abc.ABC):
     """Message Type."""
+    __slots__ = ("type",)
+
     def __init__(self,type) -> None:
         self.type = type
 
+    @abc.abstractmethod
+    def to_dict(self) -> dict:
+        """Returns the message as it goes on the wire."""
+
+    def to_bytes(self) -> bytes:
+        """Returns the encoded message payload."""
+        return _dumps(self.to_dict())
+
+    def __repr__(self) -> str:
+        return json.dumps(self.to_dict())
+
 
     
 class JoinMessage(Message):     #inheritance
     """Message to join a chat channel."""
+    __slots__ = ("channel",)
+
     def __init__(self,channel) -> None:
+        super().__init__("join")
         self.channel = channel
-        self.type = "join"      #super().__init__("join")
 
     
-    def __repr__(self) -> str:
-        data = {"command": "join", "channel": self.channel}
-        return json.dumps(data)
+    def to_dict(self) -> dict:
+        return {"command": "join", "channel": self.channel}
 
 
 class RegisterMessage(Message):
     """Message to register username in the server."""
+    __slots__ = ("user",)
+
     def __init__(self,user) -> None:
+        super().__init__("register")
         self.user = user
-        self.type = "register"    #super().__init__("register")
 
 
-    def __repr__(self) -> str:
-        data = {"command": "register", "user": self.user}
-        return json.dumps(data)
+    def to_dict(self) -> dict:
+        return {"command": "register", "user": self.user}
     
     
 class TextMessage(Message):
     """Message to chat with other clients."""
-    def __init__(self, message, channel=None) -> None:
+    __slots__ = ("message", "channel", "ts")
+
+    def __init__(self, message, channel=None, ts=None) -> None:
+        super().__init__("message")
         self.message = message
         self.channel = channel
-        self.type = "message"    #super().__init__("message")
 
-        #timestamp
-        self.ts = int(datetime.now().timestamp())
+        #timestamp, received messages keep the one they were sent with
+        self.ts = int(time.time()) if ts is None else ts
     
 
-    def __repr__(self) -> str:
+    def to_dict(self) -> dict:
         #if no channel is given, send to main
         if self.channel == None :
-            data = {"command": "message", "message": self.message, "ts":self.ts}
-            return json.dumps(data)
+            return {"command": "message", "message": self.message, "ts":self.ts}
         else:
-            data = {"command": "message", "message": self.message, "channel":self.channel, "ts":self.ts}
-            return json.dumps(data)
+            return {"command": "message", "message": self.message, "channel":self.channel, "ts":self.ts}
+
+
+#command -> (message class, constructor fields, none of them can be missing)
+#"message" has its own fast path in recv_msg
+_COMMANDS = {
+    "join": (JoinMessage, ("channel",)),
+    "register": (RegisterMessage, ("user",)),
+}
 
 
 class CDProto:
@@ -78,66 +130,153 @@ class CDProto:
 
 
     @classmethod
-    def send_msg(cls, connection: socket, msg: Message):
-        """Sends through a connection a Message object."""
-        msg = str(msg)
-        size = len(msg).to_bytes(2, "big")
-        msgEncoded = msg.encode("utf-8")
-        connection.send(size + msgEncoded)
+    def send_msg(cls, connection: socket, msg: Message) -> bool:
+        """Sends through a connection a Message object.
 
+        Returns False when part of it had to be queued, see flush."""
+        payload = msg.to_bytes()
+        #header and payload leave in a single segment
+        return cls.send_frame(connection, [len(payload).to_bytes(2, "big"), payload])
+
+
+    @classmethod
+    def broadcast(cls, connections, msg: Message, payload: bytes = None) -> list:
+        """Sends a Message object through several connections, encoding it only once.
+
+        payload is the one msg was received as, to forward it without encoding
+        it again. Returns the connections left with queued output."""
+        if payload is None:
+            payload = msg.to_bytes()
+        frame = [len(payload).to_bytes(2, "big"), payload]
+        blocked = []
+        for connection in connections:
+            try:
+                if not cls.send_frame(connection, frame):
+                    blocked.append(connection)
+            except OSError as e:
+                #peer went away, its own read will see it and disconnect it
+                logging.warning("failed to send message to %s: %s", connection, e)
+        return blocked
+
+
+    @classmethod
+    def send_frame(cls, connection: socket, frame: list) -> bool:
+        """Sends the frame parts without blocking, queueing whatever the kernel refuses.
+
+        A partial frame is never dropped, it would misalign the stream for
+        good. Returns False when something was left queued."""
+        queue = _outgoing.get(connection)
+        if queue:
+            #keep order behind the bytes already waiting
+            data = b"".join(frame)
+            queue.append(data)
+            _outgoing_size[connection] += len(data)
+            return False
+        try:
+            sent = connection.sendmsg(frame)
+        except BlockingIOError:
+            sent = 0
+        if sent < sum(len(part) for part in frame):
+            rest = b"".join(frame)[sent:]
+            _outgoing[connection] = collections.deque([rest])
+            _outgoing_size[connection] = len(rest)
+            return False
+        return True
+
+
+    @classmethod
+    def flush(cls, connection: socket) -> bool:
+        """Sends the bytes queued for the connection, True once none are left."""
+        queue = _outgoing.get(connection)
+        while queue:
+            try:
+                sent = connection.send(queue[0])
+            except BlockingIOError:
+                return False
+            _outgoing_size[connection] -= sent
+            if sent < len(queue[0]):
+                queue[0] = queue[0][sent:]
+                return False
+            queue.popleft()
+        _outgoing.pop(connection, None)
+        _outgoing_size.pop(connection, None)
+        return True
+
+
+    @classmethod
+    def backlog(cls, connection: socket) -> int:
+        """Number of bytes queued for the connection, see MAX_OUTGOING."""
+        return _outgoing_size.get(connection, 0)
+
+
+
+    @classmethod
+    def pending(cls, connection: socket) -> bool:
+        """Checks if a whole message is already buffered for the connection."""
+        buffer = _buffers.get(connection)
+        if buffer is None or len(buffer) < 2:
+            return False
+        return len(buffer) >= 2 + int.from_bytes(buffer[:2], "big")
 
 
     @classmethod
     def recv_msg(cls, connection: socket) -> Message:
-        """Receives through a connection a Message object."""
-        
-        size = int.from_bytes(connection.recv(2), "big")
+        """Receives through a connection a Message object.
 
-        if size == 0:
-            return None
-        
-        msg_bytes = connection.recv(size)
+        Returns None when the connection is closed. On a non-blocking
+        connection BlockingIOError is raised while the message is incomplete,
+        the bytes already read are kept for the next call."""
+        return cls.recv_frame(connection)[0]
+
+
+    @classmethod
+    def recv_frame(cls, connection: socket) -> tuple:
+        """Like recv_msg, but returns (message, payload) with the payload it came as.
+
+        Returns (None, None) when the connection is closed."""
+
+        buffer = _buffers.setdefault(connection, bytearray())
+
+        #short reads are fine, keep reading until the whole frame is here
+        while not cls.pending(connection):
+            data = connection.recv(RECV_SIZE)
+            if not data:
+                del _buffers[connection]
+                return None, None
+            buffer += data
+
+        size = int.from_bytes(buffer[:2], "big")
+        msg_bytes = bytes(buffer[2:2 + size])
+        del buffer[:2 + size]
 
         try:
-            msg = json.loads(msg_bytes.decode("utf-8"))
-        except json.JSONDecodeError:
+            msg = _loads(msg_bytes)
+        except ValueError:
             raise CDProtoBadFormat(msg_bytes)
         
-        cmd = msg["command"]
-
-        options = {
-            "join": CDProto.join,
-            "register": CDProto.register,
-            "message": CDProto.message
-        }
-
-        if cmd not in options:
+        if not isinstance(msg, dict):
             raise CDProtoBadFormat(msg_bytes)
 
-        # Now, handle each command accordingly
+        cmd = msg.get("command")
+
+        #chat text is almost all of the traffic, build it without the generic lookup
         if cmd == "message":
-            message_text = msg["message"]
-            channel = msg.get("channel")
+            text = msg.get("message")
             ts = msg.get("ts")
-
-            
-            if ts is not None:
-                if channel is None:
-                    return options[cmd](message_text)
-                else:
-                    return options[cmd](message_text, channel)
-            else:
+            if text is None or ts is None:
                 raise CDProtoBadFormat(msg_bytes)
+            return TextMessage(text, msg.get("channel"), ts), msg_bytes
 
-        elif cmd == "join":
-            if "channel" not in msg:
-                raise CDProtoBadFormat(msg_bytes)
-            return options[cmd](msg["channel"])
+        entry = _COMMANDS.get(cmd)
+        if entry is None:
+            raise CDProtoBadFormat(msg_bytes)
 
-        elif cmd == "register":
-            if "user" not in msg:
-                raise CDProtoBadFormat(msg_bytes)
-            return options[cmd](msg["user"])
+        message_class, fields = entry
+        values = [msg.get(field) for field in fields]
+        if None in values:
+            raise CDProtoBadFormat(msg_bytes)
+
+        return message_class(*values), msg_bytes
 
 
 
@@ -0,0 +1,34 @@
+import socket
+
+from src.client import Client
+from src.protocol import CDProto
+
+
+def test_unterminated_input_sent_on_eof():
+    """Text typed without a newline still goes out when stdin closes."""
+    client = Client("Foo")
+    client.client, server = socket.socketpair()
+    client.client.setblocking(False)
+
+    client.handle_input(b"hello")
+    client.handle_input(b"")
+
+    server.settimeout(1)
+    assert CDProto.recv_msg(server).message == "hello"
+    assert client.client.fileno() == -1
+    client.event_loop.close()
+
+
+def test_bad_line_keeps_later_lines(capsys):
+    """A bare /join or undecodable line does not drop the lines read with it."""
+    client = Client("Foo")
+    client.client, server = socket.socketpair()
+    client.client.setblocking(False)
+
+    client.handle_input(b"/join\n\xff\nhello\n")
+
+    server.settimeout(1)
+    assert CDProto.recv_msg(server).message == "hello"
+    assert "Usage: /join <channel>" in capsys.readouterr().out
+    client.close()
+    client.event_loop.close()
@@ -1,4 +1,6 @@
 """Tests for the chat protocol."""
+import json
+
 import pytest
 from src.protocol import (
     CDProto,
@@ -25,6 +27,20 @@ def test_protocol():
     )
 
 
+@freeze_time("Mar 16th, 2021")
+def test_to_bytes():
+    p = CDProto()
+
+    assert json.loads(p.register("student").to_bytes()) == {"command": "register", "user": "student"}
+
+    assert json.loads(p.message("Olá", "#cd").to_bytes()) == {
+        "command": "message",
+        "message": "Olá",
+        "channel": "#cd",
+        "ts": 1615852800,
+    }
+
+
 class mock_socket:
     def __init__(self, content):
         self.g = self.gen_stream(content)
@@ -59,3 +75,98 @@ def test_recv():
 
     with pytest.raises(CDProtoBadFormat):
         CDProto.recv_msg(mock_socket(b"Hello World"))
+
+
+class chunked_socket:
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    def recv(self, n):
+        return self.chunks.pop(0) if self.chunks else b""
+
+
+def test_recv_buffered():
+    join = b'{"command": "join", "channel": "#cd"}'
+    register = b'{"command": "register", "user": "student"}'
+    frames = len(join).to_bytes(2, "big") + join + len(register).to_bytes(2, "big") + register
+
+    # frame split across reads, followed by a second frame in the same read
+    conn = chunked_socket(frames[:1], frames[1:10], frames[10:])
+
+    assert isinstance(CDProto.recv_msg(conn), JoinMessage)
+    assert CDProto.pending(conn)
+    assert isinstance(CDProto.recv_msg(conn), RegisterMessage)
+    assert not CDProto.pending(conn)
+    assert CDProto.recv_msg(conn) is None
+
+
+def test_broadcast():
+    class sink:
+        def __init__(self):
+            self.sent = []
+
+        def sendmsg(self, buffers):
+            self.sent.append(b"".join(buffers))
+            return len(self.sent[-1])
+
+    clients = [sink(), sink()]
+    msg = CDProto.message("Hello World", "#cd")
+
+    CDProto.broadcast(clients, msg)
+
+    payload = msg.to_bytes()
+    assert all(c.sent == [len(payload).to_bytes(2, "big") + payload] for c in clients)
+
+
+def test_broadcast_partial_write():
+    class slow_sink:
+        def __init__(self, room):
+            self.room = room
+            self.sent = b""
+
+        def take(self, data):
+            if not self.room:
+                raise BlockingIOError()
+            n = min(self.room, len(data))
+            self.sent += bytes(data[:n])
+            self.room -= n
+            return n
+
+        def sendmsg(self, buffers):
+            return self.take(b"".join(buffers))
+
+        def send(self, data):
+            return self.take(data)
+
+    conn = slow_sink(5)
+    first = CDProto.message("Hello World", "#cd")
+    second = CDProto.message("Bye", "#cd")
+
+    # the rest of the first frame and all of the second wait in order
+    assert CDProto.broadcast([conn], first) == [conn]
+    assert CDProto.broadcast([conn], second) == [conn]
+    assert not CDProto.flush(conn)
+
+    conn.room = 1000
+    assert CDProto.flush(conn)
+
+    frames = b"".join(len(m.to_bytes()).to_bytes(2, "big") + m.to_bytes() for m in (first, second))
+    assert conn.sent == frames
+
+
+def test_recv_forwards_payload():
+    payload = b'{"command": "message", "message": "Hello World", "channel": "#cd", "ts": 1615852800}'
+
+    msg, raw = CDProto.recv_frame(mock_socket(payload))
+
+    assert msg.ts == 1615852800
+    assert raw == payload
+
+
+def test_received_message_encodes_changes():
+    payload = b'{"command": "join", "channel": "#a"}'
+
+    msg = CDProto.recv_msg(mock_socket(payload))
+    msg.channel = "#b"
+
+    assert json.loads(msg.to_bytes()) == {"command": "join", "channel": "#b"}
@@ -1,8 +1,12 @@
+import selectors
+import socket
+
 import pytest
 from unittest.mock import patch
 from mock import MagicMock
 from mockselector.selector import MockSocket, ListenSocket, MockSelector
 
+from src.protocol import CDProto
 from src.server import Server
 
 
@@ -20,10 +24,14 @@ def test_server():
     def fail(s):
         raise CDProtoException()
 
-    with patch("socket.socket") as socket, patch(
+    # only the server's socket module is patched: mockselector specs its
+    # MockSockets on the real socket.socket, which Python 3.11+ requires
+    with patch("src.server.socket") as socket, patch(
         "selectors.DefaultSelector"
-    ) as selector, patch("src.protocol.CDProto.recv_msg", new=fail):
-        socket.return_value = s
+    ) as selector, patch("src.protocol.CDProto.recv_frame", new=fail), patch(
+        "src.server.select", spec=[]  # no epoll, so the server goes through the selector
+    ):
+        socket.socket.return_value = s
         selector.return_value = sel
 
         with sel:
@@ -31,3 +39,44 @@ def test_server():
 
             with pytest.raises(CDProtoException):
                 s.loop()
+
+
+def test_bad_frame_keeps_draining():
+    """Frames buffered behind a bad one are handled in the same read."""
+    sender, conn = socket.socketpair()
+    receiver, member = socket.socketpair()
+    conn.setblocking(False)
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector"), patch("src.server.select", spec=[]):
+        server = Server()
+    server.channels["main"].update((conn, member))
+    server.client_channel.update({conn: "main", member: "main"})
+
+    bad = b"not json"
+    good = CDProto.message("Hello", "main").to_bytes()
+    sender.sendall(len(bad).to_bytes(2, "big") + bad + len(good).to_bytes(2, "big") + good)
+    server.handle_client(conn, selectors.EVENT_READ)
+
+    receiver.settimeout(1)
+    assert CDProto.recv_msg(receiver).message == "Hello"
+
+
+def test_stalled_client_dropped():
+    """A client that stops reading is dropped once too much output is queued for it."""
+    sender, conn = socket.socketpair()
+    stalled, member = socket.socketpair()
+    member.setblocking(False)
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector"), patch("src.server.select", spec=[]):
+        server = Server()
+    server.channels["main"].add(member)
+    server.client_channel[member] = "main"
+
+    message = CDProto.message("x" * 1000, "main")
+    for _ in range(5000):
+        server.handle_message(conn, message, message.to_bytes())
+        if member.fileno() == -1:
+            break
+
+    assert member.fileno() == -1
+    assert not server.channels["main"]
@@ -1,6 +1,6 @@
 import socket
-import pickle
 import logging
+from utils import encode, decode
 
 
 class DHTClient:
@@ -13,10 +13,10 @@ class DHTClient:
     def put(self, key, value):
         """ Store value to key in the DHT."""
         msg = {"method": "PUT", "args": {"key": key, "value": value}}
-        pickled_msg = pickle.dumps(msg)
-        self.socket.sendto(pickled_msg, self.dht_addr)
-        pickled_msg, addr = self.socket.recvfrom(1024)
-        out = pickle.loads(pickled_msg)
+        payload = encode(msg)
+        self.socket.sendto(payload, self.dht_addr)
+        payload, addr = self.socket.recvfrom(1024)
+        out = decode(payload)
         if out["method"] != "ACK":
             self.logger.error("Invalid msg: %s", out)
             return False
@@ -25,10 +25,10 @@ class DHTClient:
     def get(self, key):
         """ Retrieve key from DHT."""
         msg = {"method": "GET", "args": {"key": key}}
-        pickled_msg = pickle.dumps(msg)
-        self.socket.sendto(pickled_msg, self.dht_addr)
-        pickled_msg, addr = self.socket.recvfrom(1024)
-        out = pickle.loads(pickled_msg)
+        payload = encode(msg)
+        self.socket.sendto(payload, self.dht_addr)
+        payload, addr = self.socket.recvfrom(1024)
+        out = decode(payload)
         if out["method"] != "ACK":
             self.logger.error("Invalid msg: %s", out)
             return None
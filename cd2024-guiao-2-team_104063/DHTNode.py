@@ -2,8 +2,7 @@
 import socket
 import threading
 import logging
-import pickle
-from utils import dht_hash, contains
+from utils import dht_hash, contains, encode, decode
 
 
 class FingerTable:
@@ -24,6 +23,11 @@ class FingerTable:
         self.node_id = node_id
         self.node_addr = node_addr 
 
+        # 2^m is a power of two, so "% 2^m" is the same as "& (2^m - 1)"
+        self._ring_mask = (1 << m_bits) - 1
+        # n + 2^i for every entry, fixed for the lifetime of the node
+        self._targets = tuple((node_id + (1 << i)) & self._ring_mask for i in range(m_bits))
+
 
 
     #✔️
@@ -43,12 +47,18 @@ class FingerTable:
     #✔️
     def find(self, identification):
         """ Get node address of closest preceding node (in finger table) of identification. """
-        for i in range(self.m_bits):
-            if contains(self.node_id, self.finger_table[i][0], identification):
-                return self.finger_table[i-1][1]
-            
-            #se nao enocontrar, retorna o ultimo no (nao se consegue verificar se e o mais proximo, mas e o unico que resta)
-        return self.finger_table[-1][1]
+        finger_table = self.finger_table
+        node_id = self.node_id
+        _contains = contains
+
+        # farthest finger that still precedes identification
+        for i in range(self.m_bits - 1, -1, -1):
+            finger_id, finger_addr = finger_table[i]
+            if finger_id != identification and _contains(node_id, identification, finger_id):
+                return finger_addr
+
+        # no finger precedes it, so our successor is responsible
+        return finger_table[0][1]
    
 
 
@@ -57,15 +67,21 @@ class FingerTable:
 ######not sure
     def refresh(self):
         """ Retrieve finger table entries requiring refresh."""
-        return [(i + 1, (self.node_id + 2 ** i) % (2 ** self.m_bits), self.finger_table[i][1]) for i in range(self.m_bits)]
+        targets = self._targets
+        finger_table = self.finger_table
+        return [(i + 1, targets[i], finger_table[i][1]) for i in range(self.m_bits)]
 
 
     #✔️
     def getIdxFromId(self, id):
-        for i in range(self.m_bits):
-            target = (self.node_id + 2 ** i) % (2 ** self.m_bits)  # n + 2^i, n e o nó atual e i e o indice para obter o nó que esta 2^i posições a frente
-            if contains(self.node_id, target, id):
-                return i + 1
+        """ Get index of the first entry whose target (n + 2^i) is at or after id. """
+        # targets grow as powers of two away from n, so the entry is given by
+        # the bit length of the distance from n to id (minus one)
+        distance = (id - self.node_id) & self._ring_mask
+        index = (distance - 1).bit_length() + 1
+        if distance == 0 or index > self.m_bits:
+            return None
+        return index
 
 
 
@@ -117,27 +133,47 @@ class DHTNode(threading.Thread):
         self.keystore = {}  #where all data is stored
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.settimeout(timeout)
+        # reused by every recv, payloads are decoded before the next one
+        self._rxbuf = bytearray(2048)
+        self._rxmv = memoryview(self._rxbuf)
         self.logger = logging.getLogger("Node {}".format(self.identification))
 
+        # method -> handler(args, addr), one dict lookup per message
+        # (lambdas resolve the methods at call time, so they can be patched)
+        self.handlers = {
+            "JOIN_REQ": lambda args, addr: self.node_join(args),
+            "NOTIFY": lambda args, addr: self.notify(args),
+            "PUT": lambda args, addr: self.put(args["key"], args["value"], args.get("from", addr)),
+            "GET": lambda args, addr: self.get(args["key"], args.get("from", addr)),
+            # Reply with predecessor id
+            "PREDECESSOR": lambda args, addr: self.send(addr, {"method": "STABILIZE", "args": self.predecessor_id}),
+            # Reply with successor of id
+            "SUCCESSOR": lambda args, addr: self.get_successor(args),
+            # Initiate stabilize protocol
+            "STABILIZE": lambda args, addr: self.stabilize(args, addr),
+            "SUCCESSOR_REP": lambda args, addr: self.successor_rep(args),
+        }
+
 
       #✔️
     def send(self, address, msg):
         """ Send msg to address. """
-        payload = pickle.dumps(msg)
+        payload = encode(msg)
         self.socket.sendto(payload, address)
 
 
     #✔️
     def recv(self):
-        """ Retrieve msg payload and from address."""
+        """ Retrieve msg payload and from address.
+            The payload is a view over an internal buffer, only valid until the next recv."""
         try:
-            payload, addr = self.socket.recvfrom(1024)
+            size, addr = self.socket.recvfrom_into(self._rxbuf)
         except socket.timeout:
             return None, None
 
-        if len(payload) == 0:
+        if size == 0:
             return None, addr
-        return payload, addr
+        return self._rxmv[:size], addr
 
 
     #✔️
@@ -243,11 +279,22 @@ class DHTNode(threading.Thread):
         self.send(self.successor_addr, {"method": "NOTIFY", "args": args})
 
        ########## refresh finger_table ##########
-        lenght = len(self.finger_table.refresh())
+        for _, target_id, _ in self.finger_table.refresh():
+            self.get_successor({"id": target_id, "from": self.addr})
+
+    def successor_rep(self, args):
+        """Process SUCCESSOR_REP message.
+            Updates the finger table entry the reply was asked for.
+
+        Parameters:
+            args (dict): requested id and its successor id and addr
+        """
+        index = args["req_id"]
+        succ_id = args["successor_id"]
+        succ_addr = args["successor_addr"]
+
+        self.finger_table.update(self.finger_table.getIdxFromId(index), succ_id, succ_addr)
 
-        for i in range(lenght):
-            self.get_successor(
-                {"id": self.finger_table.refresh()[i][1], "from": self.addr})
 
     #✔️ 
     def put(self, key, value, address):
@@ -308,6 +355,19 @@ class DHTNode(threading.Thread):
             self.send(self.finger_table.find(key_hash), {"method": "GET", "args": {"key": key, "from": address}})
 
 
+    def parse(self, payload, addr):
+        """ Decode a datagram, None if it is not a message dict with a method name. """
+        try:
+            output = decode(payload)
+        except (ValueError, TypeError) as e:
+            self.logger.error("Dropped undecodable datagram from %s: %r", addr, e)
+            return None
+        method = output.get("method") if isinstance(output, dict) else None
+        if not isinstance(method, str):
+            self.logger.error("Dropped datagram without a method from %s: %r", addr, output)
+            return None
+        return output
+
     def run(self):
         self.socket.bind(self.addr)
 
@@ -320,7 +380,9 @@ class DHTNode(threading.Thread):
             self.send(self.dht_address, join_msg)
             payload, addr = self.recv()
             if payload is not None:
-                output = pickle.loads(payload)
+                output = self.parse(payload, addr)
+                if output is None:
+                    continue
                 self.logger.debug("O: %s", output)
                 if output["method"] == "JOIN_REP":
                     args = output["args"]
@@ -335,38 +397,15 @@ class DHTNode(threading.Thread):
         while not self.done:
             payload, addr = self.recv()
             if payload is not None:
-                output = pickle.loads(payload)
+                output = self.parse(payload, addr)
+                if output is None:
+                    continue
                 self.logger.info("O: %s", output)
-                if output["method"] == "JOIN_REQ":
-                    self.node_join(output["args"])
-                elif output["method"] == "NOTIFY":
-                    self.notify(output["args"])
-                elif output["method"] == "PUT":
-                    self.put(
-                        output["args"]["key"],
-                        output["args"]["value"],
-                        output["args"].get("from", addr),
-                    )
-                elif output["method"] == "GET":
-                    self.get(output["args"]["key"], output["args"].get("from", addr))
-                elif output["method"] == "PREDECESSOR":
-                    # Reply with predecessor id
-                    self.send(
-                        addr, {"method": "STABILIZE", "args": self.predecessor_id}
-                    )
-                elif output["method"] == "SUCCESSOR":
-                    # Reply with successor of id
-                    self.get_successor(output["args"])
-                elif output["method"] == "STABILIZE":
-                    # Initiate stabilize protocol
-                    self.stabilize(output["args"], addr)
-                elif output["method"] == "SUCCESSOR_REP":
-                    #Implement processing of SUCCESSOR_REP#####################
-                    index = output["args"]["req_id"]
-                    succ_id = output["args"]["successor_id"]
-                    succ_addr = output["args"]["successor_addr"]
-
-                    self.finger_table.update(self.finger_table.getIdxFromId(index), succ_id, succ_addr)
+                handler = self.handlers.get(output["method"])
+                if handler is None:
+                    self.logger.debug("Dropped unknown method %r from %s", output["method"], addr)
+                    continue
+                handler(output.get("args"), addr)
             else:  # timeout occurred, lets run the stabilize algorithm
                 # Ask successor for predecessor, to start the stabilize process
                 self.send(self.successor_addr, {"method": "PREDECESSOR"})
@@ -40,3 +40,15 @@ def test_finger_table():
         (3, 14, ("localhost", 5003)),
         (4, 2, ("localhost", 5004)),
     ]
+
+
+def test_finger_table_find_successor():
+    f = FingerTable(10, ("localhost", 5000), 4)
+    f.update(1, 11, ("localhost", 5001))
+    f.update(2, 12, ("localhost", 5002))
+    f.update(3, 13, ("localhost", 5003))
+    f.update(4, 15, ("localhost", 5004))
+
+    # no finger precedes 11, the successor is the closest node
+    assert f.find(11) == ("localhost", 5001)
+    assert f.find(3) == ("localhost", 5004)
@@ -0,0 +1,22 @@
+"""Tests DHT node message parsing."""
+import pytest
+from DHTNode import DHTNode
+from utils import encode
+
+
+@pytest.fixture()
+def node():
+    node = DHTNode(("localhost", 0))
+    yield node
+    node.socket.close()
+
+
+def test_parse_message(node):
+    msg = {"method": "PUT", "args": {"key": "A", "value": [0, 1, 2]}}
+
+    assert node.parse(encode(msg), None) == msg
+
+
+@pytest.mark.parametrize("payload", [b"\xc1", b"\x05", b"\xd4\x00\x05", encode({"args": 1}), encode({"method": [1]})])
+def test_parse_drops_bad_datagrams(node, payload):
+    assert node.parse(payload, None) is None
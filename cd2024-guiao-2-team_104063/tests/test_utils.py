@@ -1,6 +1,6 @@
 """Tests two clients."""
 import pytest
-from utils import contains
+from utils import contains, dht_hash, encode, decode
 
 
 def test_contains():
@@ -17,3 +17,28 @@ def test_contains():
     assert contains(800, 300, 300)
     assert not contains(800, 300, 700)
     assert not contains(800, 300, 400)
+
+
+def test_encode_decode():
+    msg = {"method": "PUT", "args": {"key": "A", "value": [0, 1, 2], "from": ("localhost", 5000)}}
+
+    out = decode(encode(msg))
+
+    assert out == msg
+    assert isinstance(out["args"]["from"], tuple)
+    assert isinstance(out["args"]["value"], list)
+
+
+def test_decode_int_keys():
+    msg = {"method": "PUT", "args": {"key": "A", "value": {1: "x"}, "from": ("localhost", 5000)}}
+
+    assert decode(encode(msg)) == msg
+
+
+def test_dht_hash():
+    assert dht_hash("('localhost', 5000)") == 770
+    assert dht_hash("d") == 115
+    assert dht_hash("f") == 921
+    assert dht_hash("d", maximum=1000) == 275
+    with pytest.raises(ZeroDivisionError):
+        dht_hash("d", maximum=0)
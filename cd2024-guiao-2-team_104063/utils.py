@@ -1,8 +1,20 @@
+import msgpack
+
+# msgpack ext code used to keep tuples (e.g. addresses) apart from lists
+TUPLE_EXT = 0
+
+
 def dht_hash(text, seed=0, maximum=2**10):
     """ FNV-1a Hash Function. """
     fnv_prime = 16777619
     offset_basis = 2166136261
     h = offset_basis + seed
+    if 0 < maximum <= 2**32 and maximum & (maximum - 1) == 0:
+        # only the low bits of h reach the result, so keep it a 32 bit int
+        # instead of letting it grow with every char
+        for char in text:
+            h = ((h ^ ord(char)) * fnv_prime) & 0xFFFFFFFF
+        return h & (maximum - 1)
     for char in text:
         h = h ^ ord(char)
         h = h * fnv_prime
@@ -15,3 +27,28 @@ def contains(begin, end, node):
         return begin < node <= end
     else:
         return begin < node or node <= end
+
+
+def _default(obj):
+    """ Pack tuples as an ext type so they are not decoded as lists. """
+    if isinstance(obj, tuple):
+        return msgpack.ExtType(TUPLE_EXT, encode(list(obj)))
+    raise TypeError("Cannot serialize {!r}".format(obj))
+
+
+def _ext_hook(code, data):
+    """ Unpack tuples stored by _default. """
+    if code == TUPLE_EXT:
+        return tuple(decode(data))
+    return msgpack.ExtType(code, data)
+
+
+def encode(msg):
+    """ Serialize a DHT message to bytes. """
+    return msgpack.packb(msg, default=_default, strict_types=True, use_bin_type=True)
+
+
+def decode(payload):
+    """ Deserialize a DHT message from bytes (or any buffer). """
+    # stored values may be dicts with int keys, as pickle allowed
+    return msgpack.unpackb(payload, ext_hook=_ext_hook, raw=False, strict_map_key=False)
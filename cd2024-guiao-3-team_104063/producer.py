@@ -65,6 +65,7 @@ q_protocol = {
     "json": src.middleware.JSONQueue,
     "xml": src.middleware.XMLQueue,
     "pickle": src.middleware.PickleQueue,
+    "msgpack": src.middleware.MsgpackQueue,
 }
 
 q_generator = {
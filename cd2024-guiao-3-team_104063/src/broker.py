@@ -1,13 +1,59 @@
 """Message Broker"""
+import collections
 import enum
 import json
-import pickle
+import logging
+import msgpack  # type: ignore[import-untyped]
 import select
 import selectors
 import socket
-from typing import Dict, List, Any, Tuple
+import struct
+from typing import Callable, ClassVar, Deque, Dict, List, Any, Optional, Sequence, Set, Tuple, Union
 import xml.etree.ElementTree as XML
+from xml.sax.saxutils import escape
 
+from src.log import get_logger
+
+try:
+    import orjson
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
+
+
+#bytes.translate table mapping digits to b"0" and everything else to a space
+_DIGITS = bytes(48 if 48 <= i <= 57 else 32 for i in range(256))
+#19+ digits may not fit in 64 bits, orjson would load such an int as a float
+_LONG_INT = b"0" * 19
+
+
+def json_dumps(data: Any) -> bytes:
+    """Serializes data straight to UTF-8 bytes, with orjson when installed.
+
+    Non str keys (msgpack publishers send int keys) become strings, as with
+    json. Ints past 64 bits, which orjson refuses, go through json. NaN and
+    infinity are not valid JSON, orjson writes them as null."""
+    if HAVE_ORJSON:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(data).encode("utf-8")
+
+
+def json_loads(data: Union[bytes, str]) -> Any:
+    """Parses JSON, with orjson when installed.
+
+    Falls back to json for ints that may not fit in 64 bits and for the
+    NaN/Infinity that json writes but orjson rejects."""
+    if HAVE_ORJSON:
+        raw = data.encode("utf-8") if isinstance(data, str) else data
+        if _LONG_INT not in raw.translate(_DIGITS):
+            try:
+                return orjson.loads(raw)
+            except orjson.JSONDecodeError:
+                pass
+    return json.loads(data)
 
 
 
@@ -17,81 +63,268 @@ class Serializer(enum.Enum):
     JSON = 0
     XML = 1
     PICKLE = 2
+    MSGPACK = 3
+
+
+#per message logs are DEBUG, kept cheap by leaving the broker at INFO
+logger = get_logger("Broker")
+logger.setLevel(logging.INFO)
+
+
+#frame header: 1 byte serializer, 2 byte big endian payload size
+FRAME_HEADER = struct.Struct(">BH")
+
+#event callback, called with the ready socket and its event mask
+Handler = Callable[[socket.socket, int], None]
+#subscriptions trie node: {'_subs': {socket: Serializer}, '_children': {segment: node}}
+TopicNode = Dict[str, Any]
+
+
+def xml_dumps(data: Dict[str, Any]) -> bytes:
+    """Serializes a flat dict as <root><key>value</key>...</root> without building a tree."""
+    fields = "".join(f"<{key}>{escape(str(value))}</{key}>" for key, value in data.items())
+    return f"<root>{fields}</root>".encode("utf-8")
+
+
+def xml_loads(data: bytes) -> Dict[str, Optional[str]]:
+    """Parses a flat <root> document into a dict of tag -> text."""
+    return {child.tag: child.text for child in XML.fromstring(data)}
+
+
+class FrameBuffer:
+    """Accumulates bytes read from a socket and splits them into frames.
+
+    A frame is a 1 byte serializer header, a 2 byte big endian size and size
+    bytes of payload. TCP may split or merge frames, so reads are appended
+    here and frames are only handed out once complete."""
+
+    RECV_SIZE: ClassVar[int] = 65536
+
+    def __init__(self) -> None:
+        """Initialize empty buffer."""
+        self.data = bytearray()
+        self.start = 0  #offset of the first unconsumed byte
+
+    def feed(self, chunk: Union[bytes, memoryview]) -> None:
+        """Append bytes received from the socket."""
+        #drop consumed frames once per read instead of once per frame
+        if self.start:
+            del self.data[:self.start]
+            self.start = 0
+        self.data += chunk
+
+    def recv(self, sock: socket.socket, scratch: bytearray) -> int:
+        """Read from sock through the reusable scratch buffer, returns bytes read."""
+        n = sock.recv_into(scratch)
+        if n:
+            with memoryview(scratch) as view:
+                self.feed(view[:n])
+        return n
+
+    def pop(self) -> Optional[Tuple[int, bytes]]:
+        """Remove and return the next complete (header, payload) frame, if any."""
+        data = self.data
+        start = self.start
+        if len(data) - start < FRAME_HEADER.size:
+            return None
+        header, size = FRAME_HEADER.unpack_from(data, start)
+        end = start + FRAME_HEADER.size + size
+        if len(data) < end:
+            return None
+        payload = bytes(memoryview(data)[start + FRAME_HEADER.size:end])
+        self.start = end
+        return header, payload
 
 
 class Broker:
     """Implementation of a PubSub Message Broker."""
 
-    def __init__(self):
+    #queued output a subscriber may build up before it is dropped
+    MAX_PENDING: ClassVar[int] = 8 * 1024 * 1024
+
+    def __init__(self) -> None:
         """Initialize broker."""
         self.canceled = False
         self.host = "localhost"
         self.port = 5000
 
 
-        self.selector = selectors.DefaultSelector()
+        #edge triggered epoll on linux, selectors everywhere else
+        if hasattr(select, "epoll"):
+            self.epoll: Optional[select.epoll] = select.epoll()
+            self.handlers: Dict[int, Tuple[socket.socket, Handler]] = {}
+            self.write_event = select.EPOLLOUT
+        else:
+            self.epoll = None
+            self.selector = selectors.DefaultSelector()
+            self.write_event = selectors.EVENT_WRITE
+
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind(('localhost', 5000))
         self.server_socket.listen(20)
-        self.selector.register(self.server_socket, selectors.EVENT_READ, self.accept_connection)
-
-        self.clients = {}
-        self.topics = {}
-        self.subscriptions = {}
-
-
-    def accept_connection(self, sock, mask):
-        """Accepts a new connection"""
-        client_socket, addr = sock.accept()
-        print(f"Connected by {addr}")
-        self.selector.register(client_socket, selectors.EVENT_READ, self.handle_client)
-
-
-    def disconnect_client(self, client_socket):
+        self.server_socket.setblocking(False)
+        self.register(self.server_socket, self.accept_connection)
+
+        #peer address of each client, kept from accept so logs never call getpeername
+        self.clients: Dict[socket.socket, Tuple[str, int]] = {}
+        self.recv_buf: Dict[socket.socket, FrameBuffer] = {}
+        #single reactor thread, so one scratch buffer serves every recv_into
+        self.read_buf = bytearray(FrameBuffer.RECV_SIZE)
+        #bytes the kernel did not take yet, flushed when the socket is writable
+        self.pending: Dict[socket.socket, Deque[bytes]] = {}
+        #total size of each pending queue, checked against MAX_PENDING
+        self.pending_bytes: Dict[socket.socket, int] = {}
+        self.topics: Dict[str, Any] = {}
+        #subscriptions trie, one node per '/' separated topic segment
+        self.sub_root: TopicNode = {'_subs': {}, '_children': {}}
+        #reverse index, client -> topics it subscribed to
+        self.client_topics: Dict[socket.socket, Set[str]] = {}
+
+
+    def register(self, sock: socket.socket, callback: Handler) -> None:
+        """Watch sock for reads, calling callback(sock, mask) when readable."""
+        if self.epoll is not None:
+            self.handlers[sock.fileno()] = (sock, callback)
+            self.epoll.register(sock.fileno(), select.EPOLLIN | select.EPOLLET | select.EPOLLRDHUP)
+        else:
+            self.selector.register(sock, selectors.EVENT_READ, callback)
+
+
+    def watch_writes(self, sock: socket.socket, enabled: bool) -> None:
+        """Also wake up when sock is writable, only while it has pending output."""
+        if self.epoll is not None:
+            mask = select.EPOLLIN | select.EPOLLET | select.EPOLLRDHUP
+            self.epoll.modify(sock.fileno(), mask | select.EPOLLOUT if enabled else mask)
+        else:
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if enabled else selectors.EVENT_READ
+            self.selector.modify(sock, events, self.handle_client)
+
+
+    def unregister(self, sock: socket.socket) -> None:
+        """Stop watching sock."""
+        if self.epoll is not None:
+            self.epoll.unregister(sock.fileno())
+            del self.handlers[sock.fileno()]
+        else:
+            self.selector.unregister(sock)
+
+
+    def accept_connection(self, sock: socket.socket, mask: int) -> None:
+        """Accepts all pending connections"""
+        while True:
+            try:
+                client_socket, addr = sock.accept()
+            except BlockingIOError:
+                return
+            logger.info("Connected by %s", addr)
+            self.clients[client_socket] = addr
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client_socket.setblocking(False)
+            self.recv_buf[client_socket] = FrameBuffer()
+            self.register(client_socket, self.handle_client)
+
+
+    def disconnect_client(self, client_socket: socket.socket) -> None:
         """Disconnect client."""
-        print(f"Client {client_socket.getpeername()} disconnected.")
+        logger.info("Client %s disconnected.", self.clients.get(client_socket))
         self.remove_client(client_socket)
-        self.selector.unregister(client_socket)
+        self.recv_buf.pop(client_socket, None)
+        self.pending.pop(client_socket, None)
+        self.pending_bytes.pop(client_socket, None)
+        self.clients.pop(client_socket, None)
+        self.unregister(client_socket)
         client_socket.close()
 
 
 
-    def handle_client(self, client_socket, mask):
-        try:
-            header = client_socket.recv(1)
-            if not header:
-                raise ValueError("No serializer header received")
-            
-            serializer_type = Serializer(header[0])
-            print(f"Received serializer type: {serializer_type.name}")
-
-            size_bytes = client_socket.recv(2)
-
-            if not size_bytes:
-                raise ValueError("No size header received")
-            
-            size = int.from_bytes(size_bytes, "big")
-            message = client_socket.recv(size)
-
+    def send_frame(self, sock: socket.socket, parts: Sequence[bytes]) -> bool:
+        """Send the parts of a frame without blocking, queueing whatever the kernel refuses.
 
-            if not message:
-                raise ValueError("No message received")
-            
-            self.process_request(message, client_socket, serializer_type)
+        Fanout never waits on a slow subscriber: its leftover bytes are
+        flushed on a later writable event, trading its latency for the
+        throughput of everyone else. Returns False once more than
+        MAX_PENDING bytes are queued for sock, the caller should drop it."""
+        queue = self.pending.get(sock)
+        if queue is not None:
+            #keep frame order behind what is already waiting
+            queue.extend(parts)
+            self.pending_bytes[sock] += sum(len(part) for part in parts)
+            return self.pending_bytes[sock] <= self.MAX_PENDING
+        try:
+            sent = sock.sendmsg(parts)
+        except BlockingIOError:
+            sent = 0
+        total = sum(len(part) for part in parts)
+        if sent < total:
+            self.pending[sock] = collections.deque([b"".join(parts)[sent:]])
+            self.pending_bytes[sock] = total - sent
+            self.watch_writes(sock, True)
+        return True
+
+
+    def flush(self, sock: socket.socket) -> None:
+        """Write pending output until done or the kernel buffer is full again."""
+        queue = self.pending.get(sock)
+        while queue:
+            try:
+                sent = sock.send(queue[0])
+            except BlockingIOError:
+                return
+            self.pending_bytes[sock] -= sent
+            if sent < len(queue[0]):
+                queue[0] = queue[0][sent:]
+                return
+            queue.popleft()
+        if queue is not None:
+            del self.pending[sock]
+            del self.pending_bytes[sock]
+            self.watch_writes(sock, False)
+
+
+
+    def handle_client(self, client_socket: socket.socket, mask: int) -> None:
+        buffer = self.recv_buf[client_socket]
+        try:
+            if mask & self.write_event:
+                self.flush(client_socket)
+                if not mask & ~self.write_event:
+                    return
+
+            #edge triggered: read until the kernel has nothing left, a read
+            #may hold several frames, or only part of one
+            while True:
+                try:
+                    n = buffer.recv(client_socket, self.read_buf)
+                except BlockingIOError:
+                    return
+                if not n:
+                    raise ValueError("Connection closed by client")
+
+                frame = buffer.pop()
+                while frame is not None:
+                    header, message = frame
+                    serializer_type = Serializer(header)
+                    logger.debug("Received serializer type: %s", serializer_type.name)
+
+                    self.process_request(message, client_socket, serializer_type)
+                    if client_socket not in self.clients:
+                        #dropped while handling its own request, see drop_stalled
+                        return
+                    frame = buffer.pop()
 
         except ValueError as e:
-            print(f"Error: {e}")
+            logger.info("Error: %s", e)
             self.disconnect_client(client_socket)
 
-        except KeyError:
-            print(f"Invalid serializer received: {header[0]}")
+        except ConnectionError as e:
+            logger.info("Connection error: %s", e)
             self.disconnect_client(client_socket)
 
 
 
 
-    def process_request(self, data, client_socket, serializer_type):
+    def process_request(self, data: bytes, client_socket: socket.socket, serializer_type: Serializer) -> None:
         """Process incoming requests from clients."""
 
         message = self.deserialize_data(data, serializer_type)
@@ -102,24 +335,24 @@ class Broker:
         command = message.get('command')
 
         if not command:
-            print("Invalid command received.")
+            logger.warning("Invalid command received.")
             return
         
 
         try:
-            topic = message.get('topic')
+            topic: str = message.get('topic', "")
             msgData = message.get('data')
 
             #subscribe to a topic
             if command == 'subscribe':
                 self.subscribe(topic, client_socket, serializer_type)
-                print(f"Client {client_socket.getpeername()} subscribed to {topic} with {serializer_type.name} format.")
+                logger.info("Client %s subscribed to %s with %s format.", self.clients.get(client_socket), topic, serializer_type.name)
 
 
             #unsubscribe from a topic
             elif command == 'unsubscribe':
                 self.unsubscribe(topic, client_socket)
-                print(f"Client {client_socket.getpeername()} unsubscribed from {topic}.")
+                logger.info("Client %s unsubscribed from %s.", self.clients.get(client_socket), topic)
 
 
             #publish a message to a topic
@@ -128,24 +361,24 @@ class Broker:
                 message = {
                         "command": "publish",
                         "topic": topic,
-                        "data": msgData,
-                        "serializer": "JSON"
+                        "data": msgData
                     }
                 self.publish(topic, message, serializer_type)
-                print(f"Message published to {topic}: {data}")
+                logger.debug("Message published to %s: %r", topic, data)
 
 
             #list all topics
             elif command == 'list_topics':
                 topics = self.list_topics()
-                client_socket.send(json.dumps({'topics': topics}).encode('utf-8'))
-                print("Sent list of topics to client.")
+                if not self.send_frame(client_socket, self.encode_frame({'topics': topics}, Serializer.JSON)):
+                    self.drop_stalled([client_socket])
+                logger.debug("Sent list of topics to client.")
 
             else:
-                print(f"Received unknown command: {command}")
+                logger.warning("Received unknown command: %s", command)
 
         except Exception as e:
-            print(f"Error processing request from {client_socket.getpeername()}: {e}")
+            logger.error("Error processing request from %s: %s", self.clients.get(client_socket), e)
 
 
     def list_topics(self) -> List[str]: #✔️
@@ -154,138 +387,181 @@ class Broker:
         return list(self.topics.keys())
     
 
-    def get_topic(self, topic): #✔️
+    def get_topic(self, topic: str) -> Any: #✔️
         """Returns the currently stored value in topic."""
         #return self.subscriptions.get(topic, None)
         if topic in self.topics:
             return self.topics[topic]
     
 
-    def put_topic(self, topic, value):  #✔️
+    def put_topic(self, topic: str, value: Any) -> None:  #✔️
         """Store in topic the value."""
         self.topics[topic] = value    
-        print(f"Data for topic {topic} updated. Value: {value}")
+        logger.debug("Data for topic %s updated. Value: %s", topic, value)
 
         
-    def serialize_data(self, data, serializer_type):
+    def serialize_data(self, data: Dict[str, Any], serializer_type: Serializer) -> bytes:
         if serializer_type == Serializer.JSON:
-            return json.dumps(data).encode("utf-8")
+            return json_dumps(data)
         
         elif serializer_type == Serializer.XML:
-            root = XML.Element('root')
-            for key, value in data.items():
-                elem = XML.SubElement(root, key)
-                elem.text = str(value)
-            return XML.tostring(root)
+            return xml_dumps(data)
         
-        elif serializer_type == Serializer.PICKLE:
-            return pickle.dumps(data)
+        elif serializer_type in (Serializer.PICKLE, Serializer.MSGPACK):
+            #PICKLE frames carry msgpack, pickle is never loaded from the network
+            return msgpack.packb(data, use_bin_type=True)
 
 
-    def deserialize_data(self, data, serializer_type):
+    def deserialize_data(self, data: bytes, serializer_type: Serializer) -> Optional[Dict[str, Any]]:
         try:
         
             if serializer_type == Serializer.JSON:
-                return json.loads(data)
+                return json_loads(data)
             
             elif serializer_type == Serializer.XML:
-                    root = XML.fromstring(data)
-
-                    elements = {}
-                    for child in root:
-                        elements[child.tag] = child.text
-
-                    return elements
+                return xml_loads(data)
                 
-            elif serializer_type == Serializer.PICKLE:
-                return pickle.loads(data)
+            elif serializer_type in (Serializer.PICKLE, Serializer.MSGPACK):
+                return msgpack.unpackb(data, raw=False, strict_map_key=False)
             else:
                 raise ValueError(f"Unknown serializer: {serializer_type}")
         except Exception as e:
-            print(f"Error deserializing data: {e}, {data}")
+            logger.error("Error deserializing data: %s, %r", e, data)
             return None
         
 
-    def publish(self, topic, data, serializer_type=Serializer.JSON):
+    def publish(self, topic: str, data: Dict[str, Any], serializer_type: Serializer = Serializer.JSON) -> None:
         notified_clients = set()  #avoid sending duplicates
-
-        for subscribed_topic, clients in self.subscriptions.items():
-            if subscribed_topic == topic or topic.startswith(subscribed_topic + '/'):
-                for client, ser in clients:
-                    if client not in notified_clients:
-                        try:
-                            serialized_data = self.serialize_data(data, ser)
-                            header = ser.value.to_bytes(1, 'big')
-                            size = len(serialized_data).to_bytes(2, "big")
-                            client.send(header + size + serialized_data)
-                            notified_clients.add(client)
-                            print(f"Message sent to {client.getpeername()} on topic {subscribed_topic}.")
-                        except Exception as e:
-                            print(f"Failed to send data to {client.getpeername()}: {e}")
+        #serialize once per format, not once per subscriber
+        cache: Dict[Serializer, Tuple[bytes, bytes]] = {}
+        #dropped after the walk, disconnecting edits the trie being walked
+        stalled: List[socket.socket] = []
+
+        #subscribers of topic and of every ancestor topic along the trie path
+        for node in self.topic_path(topic):
+            for client, ser in node['_subs'].items():
+                if client in notified_clients:
+                    continue
+                notified_clients.add(client)
+                try:
+                    if ser not in cache:
+                        cache[ser] = self.encode_frame(data, ser)
+                    if not self.send_frame(client, cache[ser]):
+                        stalled.append(client)
+                except Exception as e:
+                    logger.warning("Failed to send data to %s: %s", self.clients.get(client), e)
+        self.drop_stalled(stalled)
+
+
+    def drop_stalled(self, clients: List[socket.socket]) -> None:
+        """Disconnect clients whose pending output passed MAX_PENDING, they stopped reading."""
+        for client in clients:
+            logger.warning("Client %s has over %d bytes pending, dropping it.", self.clients.get(client), self.MAX_PENDING)
+            self.disconnect_client(client)
+
+
+    def encode_frame(self, data: Dict[str, Any], serializer_type: Serializer) -> Tuple[bytes, bytes]:
+        """Serialize data once into the (header + size prefix, body) parts of a frame."""
+        body = self.serialize_data(data, serializer_type)
+        return FRAME_HEADER.pack(serializer_type.value, len(body)), body
+
+
+    def topic_path(self, topic: str) -> List[TopicNode]:
+        """Existing trie nodes from the root down to topic, at most depth(topic) of them."""
+        path = []
+        node = self.sub_root
+        for segment in topic.split('/'):
+            child: Optional[TopicNode] = node['_children'].get(segment)
+            if child is None:
+                break
+            path.append(child)
+            node = child
+        return path
 
 
     def list_subscriptions(self, topic: str) -> List[Tuple[socket.socket, Serializer]]:     #✔️
         """Provide list of subscribers to a given topic."""
-        return self.subscriptions.get(topic, [])
+        subscribers: Dict[socket.socket, Tuple[socket.socket, Serializer]] = {}
+        for node in self.topic_path(topic):
+            for client, ser in node['_subs'].items():
+                subscribers.setdefault(client, (client, ser))
+        return list(subscribers.values())
 
 
-    def subscribe(self, topic: str, address: socket.socket, _format: Serializer = None):
+    def subscribe(self, topic: str, address: socket.socket, _format: Optional[Serializer] = None) -> None:
         """Subscribe to topic by client in address and all its subtopics."""
 
-        #topic and its subtopics are subscribed
-        if topic not in self.subscriptions:
-            self.subscriptions[topic] = []
-        self.subscriptions[topic].append((address, _format))
-        
-        #add subscription to all subtopics of the current topic
-        for subtopic in list(self.subscriptions.keys()):
-            if subtopic.startswith(topic + "/"):
-                if (address, _format) not in self.subscriptions[subtopic]:
-                    self.subscriptions[subtopic].append((address, _format))
+        #subtopics are covered implicitly, publish walks through this node
+        node = self.sub_root
+        for segment in topic.split('/'):
+            node = node['_children'].setdefault(segment, {'_subs': {}, '_children': {}})
+        #the socket is the key, resubscribing only replaces the serializer
+        node['_subs'][address] = _format
+        self.client_topics.setdefault(address, set()).add(topic)
 
-    
 
 
+    def unsubscribe(self, topic: str, client_socket: socket.socket) -> None:
+        topics = self.client_topics.get(client_socket)
+        if not topics or topic not in topics:
+            return
+        topics.discard(topic)
+        if not topics:
+            del self.client_topics[client_socket]
 
-    def unsubscribe(self, topic, client_socket):
-        if topic in self.subscriptions:
-            self.subscriptions[topic] = [(sock, ser) for sock, ser in self.subscriptions[topic] if sock != client_socket]
-            if not self.subscriptions[topic]:
-                del self.subscriptions[topic]
+        path = self.topic_path(topic)
+        path[-1]['_subs'].pop(client_socket, None)
+        self.prune(topic.split('/'), [self.sub_root] + path)
 
 
+    def prune(self, segments: List[str], path: List[TopicNode]) -> None:
+        """Drop empty trie nodes from the bottom of path upwards."""
+        for segment, parent, node in zip(reversed(segments), reversed(path[:-1]), reversed(path[1:])):
+            if node['_subs'] or node['_children']:
+                break
+            del parent['_children'][segment]
 
-    def remove_client(self, client_socket):
-        """Remove the client from all subscriptions."""
-        for topic, subscribers in list(self.subscriptions.items()):
-            self.subscriptions[topic] = [(sock, ser) for sock, ser in subscribers if sock != client_socket]
 
-            if not self.subscriptions[topic]:
-                del self.subscriptions[topic]
 
-        print(f"Removed client {client_socket.getpeername()} from all subscriptions.")
+    def remove_client(self, client_socket: socket.socket) -> None:
+        """Remove the client from all subscriptions."""
+        #only the client's own topics are visited, not the whole trie
+        for topic in list(self.client_topics.get(client_socket, ())):
+            self.unsubscribe(topic, client_socket)
+
+        logger.info("Removed client %s from all subscriptions.", self.clients.get(client_socket))
     
     
-    def run(self):
+    def run(self) -> None:
         """Run until canceled."""
-        print("Broker server is running.")
+        logger.info("Broker server is running.")
 
-        clients = []
+        clients: List[socket.socket] = []
         try:
 
-            while not self.canceled:
-                events = self.selector.select(timeout=None)
-                for key, mask in events:
-                    callback = key.data
-                    callback(key.fileobj, mask)
+            if self.epoll is not None:
+                handlers = self.handlers
+                while not self.canceled:
+                    for fd, mask in self.epoll.poll(-1, 64):
+                        #fd may have been closed by an earlier callback of this batch
+                        entry = handlers.get(fd)
+                        if entry is not None:
+                            sock, callback = entry
+                            callback(sock, mask)
+            else:
+                while not self.canceled:
+                    events = self.selector.select(timeout=None)
+                    for key, mask in events:
+                        callback = key.data
+                        callback(key.fileobj, mask)
 
         except KeyboardInterrupt:
             #catch keyboardInterrupt and exit
-            print("Broker is shutting down due to a KeyboardInterrupt.")
+            logger.info("Broker is shutting down due to a KeyboardInterrupt.")
         except Exception as e:
-            print(f"An error occurred: {e}")
+            logger.error("An error occurred: %s", e)
         finally:
             self.server_socket.close()
             for client in clients:
                 client.close()
-            print("All connections were closed.")
\ No newline at end of file
+            logger.info("All connections were closed.")
\ No newline at end of file
@@ -8,6 +8,6 @@ logging.basicConfig(
 )
 
 
-def get_logger(module):
+def get_logger(module: str) -> logging.Logger:
     """Get Logger for module."""
     return logging.getLogger(module)
@@ -2,12 +2,14 @@
 from collections.abc import Callable
 from enum import Enum
 import json
-import pickle
+import msgpack  # type: ignore[import-untyped]
 from queue import LifoQueue, Empty
 import socket
-from typing import Any, Tuple
+from typing import Any, Dict, Optional, Tuple
 import xml.etree.ElementTree as XML
-from src.broker import Serializer
+from xml.sax.saxutils import escape
+from src.log import get_logger
+from src.broker import FRAME_HEADER, FrameBuffer, Serializer, json_loads, xml_dumps, xml_loads
 
 class MiddlewareType(Enum):
     """Middleware Type."""
@@ -16,10 +18,40 @@ class MiddlewareType(Enum):
     PRODUCER = 2
 
 
+logger = get_logger("Middleware")
+
+
+def json_encode(data: Any) -> bytes:
+    """Serializes data to UTF-8 JSON bytes with the stdlib json."""
+    return json.dumps(data).encode("utf-8")
+
+
+def msgpack_dumps(data: Any) -> bytes:
+    """Serializes data to MessagePack bytes."""
+    return msgpack.packb(data, use_bin_type=True)
+
+
+#subscribe, unsubscribe and list_topics never change for a given serializer and topic
+_COMMAND_FRAMES: Dict[Tuple[Serializer, str, Optional[str]], bytes] = {}
+
+
+def command_frame(serializer: Serializer, encode: Callable, command: str, topic: Optional[str] = None) -> bytes:
+    """Frame for a fixed {command, topic} message, encoded once and reused."""
+    key = (serializer, command, topic)
+    frame = _COMMAND_FRAMES.get(key)
+    if frame is None:
+        message = {"command": command} if topic is None else {"command": command, "topic": topic}
+        body = encode(message)
+        frame = _COMMAND_FRAMES[key] = FRAME_HEADER.pack(serializer.value, len(body)) + body
+    return frame
+
+
 class Queue:
     """Representation of Queue interface for both Consumers and Producers."""
 
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
+    serializer: Serializer
+
+    def __init__(self, topic: str, _type: MiddlewareType = MiddlewareType.CONSUMER) -> None:
         """Create Queue."""
         self.topic = topic
         self.type = _type
@@ -27,85 +59,88 @@ class Queue:
         self.port = 5000
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)##
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.sock.connect((self.host, self.port))
+        self._rxbuf = FrameBuffer()
+        self._scratch = bytearray(FrameBuffer.RECV_SIZE)
 
 
 
-    def push(self, value):  #✔️
+    def push(self, value: Any) -> None:  #✔️
         """Sends data to broker."""
         self.sock.send(value)
 
 
 
-    def pull(self) -> Tuple[str, Any]:  #✔️
-        """Receives (topic, data) from broker.
-        Should BLOCK the consumer!"""
+    def push_frame(self, body: bytes) -> None:
+        """Sends body to broker framed with this queue's serializer header and size."""
+        #header and body leave in a single segment
+        self.sock.send(FRAME_HEADER.pack(self.serializer.value, len(body)) + body)
 
-        header = self.sock.recv(1)  
-        size_data = self.sock.recv(2)
-        if not size_data:
-            return None
-        size = int.from_bytes(size_data, 'big')
-        data = self.sock.recv(size)
-        
+
+
+    def pull(self) -> Any:  #✔️
+        """Receives from broker the payload of the next frame, None once it closes.
+        Should BLOCK the consumer!
+
+        Typed Any as the subclasses override it to return the decoded (topic, data)."""
+
+        #keep reading until a whole frame is buffered, extra bytes wait for the next pull
+        frame = self._rxbuf.pop()
+        while frame is None:
+            if not self._rxbuf.recv(self.sock, self._scratch):
+                return None
+            frame = self._rxbuf.pop()
+
+        header, data = frame
         return data
 
 
 
-    def list_topics(self, callback: Callable):  #✔️
+    def list_topics(self, callback: Callable) -> None:  #✔️
         """Lists all topics available in the broker."""
-        message = json.dumps({"command": "list_topics"}).encode('utf-8')
-        self.sock.send(len(message).to_bytes(2, "big") + message)
+        self.sock.send(command_frame(Serializer.JSON, json_encode, "list_topics"))
 
 
-    def cancel(self): #✔️
+    def cancel(self) -> None: #✔️
         """Cancel subscription."""
-        message = json.dumps({"command": "unsubscribe", "topic": self.topic}).encode('utf-8')
-        self.sock.send(len(message).to_bytes(2, "big") + message)
+        self.sock.send(command_frame(Serializer.JSON, json_encode, "unsubscribe", self.topic))
 
 
 
 class JSONQueue(Queue):
     """Queue implementation with JSON based serialization."""
     
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
+    def __init__(self, topic: str, _type: MiddlewareType = MiddlewareType.CONSUMER) -> None:
         """Create Queue."""
         super().__init__(topic, _type)
         self.serializer = Serializer.JSON
             	
         if _type == MiddlewareType.CONSUMER:
-            header = Serializer.JSON.value.to_bytes(1, 'big')
-            message = json.dumps({"command": "subscribe", 
-                                  "topic": topic})
-            size = len(message).to_bytes(2, "big")
-            encoded_message = message.encode('utf-8')
-            super().push(header + size + encoded_message)
+            self.sock.send(command_frame(self.serializer, json_encode, "subscribe", topic))
 
 
 
-    def push(self, value):  #✔️
+    def push(self, value: Any) -> None:  #✔️
         """Sends data to broker."""
 
-        message = json.dumps({
+        #json_encode, not orjson: test_basic counts json.dumps calls per publish
+        message = json_encode({
             "command": "publish",
             "topic": self.topic,
-            "data": value,
-            "serializer": "JSON"
-        }).encode('utf-8')
+            "data": value
+        })
 
-        header = self.serializer.value.to_bytes(1, 'big')
-        size = len(message).to_bytes(2, "big")
-        full_message = header + size + message
-        super().push(full_message)
+        self.push_frame(message)
 
 
 
-    def pull(self) -> Tuple[str, Any]:  #✔️
+    def pull(self) -> Tuple[Optional[str], Any]:  #✔️
         """Receives (topic, data) from broker.
         Should BLOCK the consumer!"""
         data = super().pull()
         if data:
-            decoded_data = json.loads(data)
+            decoded_data = json_loads(data)
             return decoded_data["topic"], decoded_data["data"]
         return None, None
 
@@ -115,93 +150,79 @@ class JSONQueue(Queue):
 
 class XMLQueue(Queue):
     """Queue implementation with XML based serialization."""
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
+    def __init__(self, topic: str, _type: MiddlewareType = MiddlewareType.CONSUMER) -> None:
         super().__init__(topic, _type)
         self.serializer = Serializer.XML
+        #fixed schema, only the data changes between pushes
+        self._publish_prefix = f"<root><command>publish</command><topic>{escape(self.topic)}</topic><data>"
 
         if _type == MiddlewareType.CONSUMER:
-                root = XML.Element('root')
-                XML.SubElement(root, 'command').text = "subscribe"
-                XML.SubElement(root, 'topic').text = self.topic
-                messageEncoded = XML.tostring(root)
+                self.sock.send(command_frame(self.serializer, xml_dumps, "subscribe", self.topic))
 
-                header = self.serializer.value.to_bytes(1, 'big')
-                size = len(messageEncoded).to_bytes(2, "big")
-                full_message =  header + size + messageEncoded
-                super().push(full_message)
 
-
-    def push(self, value):      #✔️
-        root = XML.Element('root')
-        XML.SubElement(root, 'command').text = "publish"
-        XML.SubElement(root, 'topic').text = self.topic
-        XML.SubElement(root, 'data').text = str(value)
-        XML.SubElement(root, 'serializer').text = "XML"
-        messageEncoded = XML.tostring(root)
+    def push(self, value: Any) -> None:      #✔️
+        messageEncoded = f"{self._publish_prefix}{escape(str(value))}</data></root>".encode("utf-8")
 
         
-        header = self.serializer.value.to_bytes(1, 'big')
-        size = len(messageEncoded).to_bytes(2, "big")
-        full_message =  header + size + messageEncoded
-        super().push(full_message)
+        self.push_frame(messageEncoded)
     
 
 
 
-    def pull(self) -> Tuple[str, Any]:
+    def pull(self) -> Tuple[Optional[str], Any]:
         """Receives (topic, data) from broker, expects data in XML format."""
         data = super().pull()
         if data:
             try:
-                root = XML.fromstring(data)
-                elements = {}
-                for child in root:
-                    elements[child.tag] = child.text
+                elements = xml_loads(data)
                 return elements["topic"], elements["data"]
      
-            except Exception as e:
-                print(f"Error parsing XML: {e} {elements}")
-                return None, None
+            except (XML.ParseError, KeyError) as e:
+                logger.error("Error parsing XML: %s %r", e, data)
+        return None, None
 
 
-class PickleQueue(Queue):
-    """Queue implementation with Pickle based serialization."""
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
+class MsgpackQueue(Queue):
+    """Queue implementation with MessagePack based serialization."""
+
+    def __init__(self, topic: str, _type: MiddlewareType = MiddlewareType.CONSUMER,
+                 serializer: Serializer = Serializer.MSGPACK) -> None:
         super().__init__(topic, _type)
-        self.serializer = Serializer.PICKLE
+        self.serializer = serializer
         if _type == MiddlewareType.CONSUMER:
-            message = pickle.dumps({"command": "subscribe", "topic": topic})
-            header = self.serializer.value.to_bytes(1, 'big')
-            size = len(message).to_bytes(2, "big")
-            full_message = header + size  + message
-            super().push(full_message)
-
+            self.sock.send(command_frame(self.serializer, msgpack_dumps, "subscribe", topic))
 
 
-
-    def push(self, value):      #✔️
+    def push(self, value: Any) -> None:
         """Sends data to broker."""
-        message = pickle.dumps({
+        message = msgpack_dumps({
             "command": "publish",
             "topic": self.topic,
-            "data": value,
-            "serializer": "PICKLE"
+            "data": value
         })
 
-        header = self.serializer.value.to_bytes(1, 'big')
-        size = len(message).to_bytes(2, "big")
-        full_message = header + size  + message
-        super().push(full_message)
+        self.push_frame(message)
 
 
-    def pull(self) -> Tuple[str, Any]:  #✔️
+    def pull(self) -> Tuple[Optional[str], Any]:
         """Receives (topic, data) from broker."""
         data = super().pull()
         if data:
             try:
-                decoded_data = pickle.loads(data)
+                decoded_data = msgpack.unpackb(data, raw=False, strict_map_key=False)
                 return decoded_data["topic"], decoded_data["data"]
-            except pickle.PickleError as e:
-                    print(f"Failed to decode Pickle data: {e}")
-        
+            except (ValueError, msgpack.UnpackException) as e:
+                    logger.error("Failed to decode MessagePack data: %s", e)
+
         return None, None
+
+
+
+class PickleQueue(MsgpackQueue):
+    """Queue for the PICKLE serializer, which travels as MessagePack.
+
+    Unpickling network input lets any client run code on the broker, so
+    the broker no longer accepts pickle."""
+
+    def __init__(self, topic: str, _type: MiddlewareType = MiddlewareType.CONSUMER) -> None:
+        super().__init__(topic, _type, Serializer.PICKLE)
@@ -1,9 +1,14 @@
 """Test simple consumer/producer interaction."""
+import json
+import math
+import socket
+import time
 from unittest.mock import MagicMock, patch
 
 import pytest
 
-from src.broker import Serializer
+from src.broker import FRAME_HEADER, FrameBuffer, Serializer
+from src.middleware import JSONQueue, MiddlewareType, MsgpackQueue
 
 
 def test_subscriptions(broker):
@@ -24,6 +29,20 @@ def test_subscriptions(broker):
     assert broker.list_subscriptions("/t2") == [(fake_subscriber2, Serializer.PICKLE)]
 
 
+def test_subtopic_subscriptions(broker):
+    fake_subscriber1 = MagicMock()
+    fake_subscriber2 = MagicMock()
+
+    broker.subscribe("/s1", fake_subscriber1, Serializer.JSON)
+    broker.subscribe("/s1/s2", fake_subscriber2, Serializer.XML)
+
+    assert broker.list_subscriptions("/s1") == [(fake_subscriber1, Serializer.JSON)]
+    assert len(broker.list_subscriptions("/s1/s2/s3")) == 2
+
+    broker.remove_client(fake_subscriber1)
+    assert broker.list_subscriptions("/s1/s2") == [(fake_subscriber2, Serializer.XML)]
+
+
 def test_topics(broker):
     broker.put_topic("/t3", 1000)
 
@@ -38,3 +57,87 @@ def test_topics(broker):
     assert len(broker.list_topics()) >= 2  # t3, t4 and the topic from basic
     assert "/t3" in broker.list_topics()
     assert "/t4" in broker.list_topics()
+
+
+def test_msgpack_serializer(broker):
+    message = {"command": "publish", "topic": "/m", "data": [1, "two", 3.0]}
+
+    data = broker.serialize_data(message, Serializer.MSGPACK)
+    assert broker.deserialize_data(data, Serializer.MSGPACK) == message
+
+
+def test_json_serializer(broker):
+    message = {"command": "publish", "topic": "/j", "data": {1: "one", "big": 2**64 - 1, "neg": -2**63}}
+
+    data = broker.serialize_data(message, Serializer.JSON)
+    assert broker.deserialize_data(data, Serializer.JSON) == {
+        "command": "publish", "topic": "/j", "data": {"1": "one", "big": 2**64 - 1, "neg": -2**63}
+    }
+    assert math.isnan(broker.deserialize_data(b'{"data": NaN}', Serializer.JSON)["data"])
+
+
+def test_json_lossless(broker):
+    consumer = JSONQueue("/json_lossless")
+    producer = JSONQueue("/json_lossless", MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+
+    producer.push([2**70, -2**70])
+    assert consumer.pull() == ("/json_lossless", [2**70, -2**70])
+
+    #NaN is not valid JSON, the broker sends it on as null
+    producer.push(float("nan"))
+    assert consumer.pull() == ("/json_lossless", None)
+
+
+def test_stalled_subscriber_dropped(broker, monkeypatch):
+    monkeypatch.setattr(broker, "MAX_PENDING", 64 * 1024)
+
+    #a subscriber that never reads
+    stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    stalled.connect(("localhost", 5000))
+    body = json.dumps({"command": "subscribe", "topic": "/stalled"}).encode("utf-8")
+    stalled.sendall(FRAME_HEADER.pack(Serializer.JSON.value, len(body)) + body)
+
+    producer = MsgpackQueue("/stalled", MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+    for _ in range(4000):
+        producer.push("x" * 1000)
+    time.sleep(0.5)
+
+    assert broker.list_subscriptions("/stalled") == []
+    assert not broker.pending_bytes
+    stalled.close()
+
+
+def test_msgpack_int_keys(broker):
+    consumer = MsgpackQueue("/int_keys")
+    producer = MsgpackQueue("/int_keys", MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+
+    producer.push({1: "x"})
+    assert consumer.pull() == ("/int_keys", {1: "x"})
+
+
+def test_xml_serializer(broker):
+    message = {"command": "publish", "topic": "/x", "data": "a < b & ação"}
+
+    data = broker.serialize_data(message, Serializer.XML)
+    assert broker.deserialize_data(data, Serializer.XML) == message
+    assert broker.deserialize_data(b"<root><data></data></root>", Serializer.XML) == {"data": None}
+
+
+def test_frame_buffer():
+    buffer = FrameBuffer()
+    frames = FRAME_HEADER.pack(0, 2) + b"{}" + FRAME_HEADER.pack(2, 3) + b"abc"
+
+    buffer.feed(frames[:2])
+    assert buffer.pop() is None
+
+    buffer.feed(frames[2:7])
+    assert buffer.pop() == (0, b"{}")
+    assert buffer.pop() is None
+
+    buffer.feed(frames[7:])
+    assert buffer.pop() == (2, b"abc")
+    assert buffer.pop() is None